@@ -11,16 +11,21 @@ Chart:
 """
 
 import asyncio
+import queue
+import struct
+import threading
 import time
 from collections import deque
-from dataclasses import dataclass
-from datetime import datetime
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
 
 from bleak import BleakClient, BleakScanner
 from nicegui import ui
+import numpy as np
 
 # ------------------- BLE CONFIG -------------------
 DEVICE_NAME = "XIAO_Flow"
+NUS_SERVICE_UUID = "6E400001-B5A3-F393-E0A9-E50E24DCCA9E"  # advertised
 NUS_TX_UUID = "6E400003-B5A3-F393-E0A9-E50E24DCCA9E"  # notify/read
 
 # ------------------- SIP DETECTION TUNING -------------------
@@ -32,13 +37,20 @@ SIP_GAP_SECONDS = 2.0
 
 # ------------------- CHART TUNING -------------------
 CHART_SECONDS_WINDOW = 120  # show last N seconds on chart
-UI_REFRESH_S = 0.5
+SAMPLE_PERIOD_S = 0.1       # firmware CALC_INTERVAL (100 ms)
+CHART_MAXLEN = int(CHART_SECONDS_WINDOW / SAMPLE_PERIOD_S) + 50  # points kept
+UI_REFRESH_S = 0.5          # chips + metric labels
+CHART_REFRESH_S = 2.0       # chart redraw (heavier echart diff)
+
+# ------------------- RX TUNING -------------------
+RX_BATCH_S = 0.05  # collect notifications for this long, then process together
 
 
 # ------------------- DATA MODEL -------------------
 @dataclass
 class FlowSample:
-    ts: float
+    ts: float              # wall clock, for display and day rollover
+    mono: float            # time.monotonic(), for sip gaps and chart axis
     pulses: int
     freq_hz: float
     flow_lpm: float
@@ -46,219 +58,345 @@ class FlowSample:
     total_l: float         # lifetime total from device (L)
 
 
-def parse_csv_payload(s: str) -> FlowSample | None:
-    """
-    Expected CSV from ESP32:
-      pulses,frequency_hz,flow_l_min,vol_ml_interval,total_l
-    """
-    s = s.strip()
-    if not s or "pulses" in s.lower():
-        return None
+# Binary frame from ESP32 (little-endian, 20 bytes):
+#   uint32 pulses, float32 frequency_hz, flow_l_min, vol_ml_interval, total_l
+FRAME = struct.Struct("<Iffff")
+_UNPACK = FRAME.unpack
 
-    parts = [p.strip() for p in s.split(",")]
-    if len(parts) != 5:
-        return None
 
-    try:
-        return FlowSample(
-            ts=time.time(),
-            pulses=int(parts[0]),
-            freq_hz=float(parts[1]),
-            flow_lpm=float(parts[2]),
-            vol_ml=float(parts[3]),
-            total_l=float(parts[4]),
-        )
-    except ValueError:
+def parse_binary_payload(ts: float, mono: float,
+                         data: bytes) -> FlowSample | None:
+    # ts/mono are stamped on arrival (on_notify), not when the batch is parsed
+    if len(data) != FRAME.size:
         return None
 
+    pulses, freq_hz, flow_lpm, vol_ml, total_l = _UNPACK(data)
+    return FlowSample(
+        ts=ts,
+        mono=mono,
+        pulses=pulses,
+        freq_hz=freq_hz,
+        flow_lpm=flow_lpm,
+        vol_ml=vol_ml,
+        total_l=total_l,
+    )
+
 
 # ------------------- APP STATE -------------------
-state = {
-    "running": False,
-    "connected": False,
-    "status": "Idle",
-    "last_sample": None,     # FlowSample | None
-    "client": None,          # BleakClient | None
-    "task": None,            # asyncio.Task | None
+def next_local_midnight_ts() -> float:
+    tomorrow = date.today() + timedelta(days=1)
+    return datetime.combine(tomorrow, datetime.min.time()).timestamp()
+
+
+@dataclass(slots=True)
+class AppState:
+    running: bool = False
+    connected: bool = False
+    status: str = "Idle"
+    last_sample: FlowSample | None = None
+    client: BleakClient | None = None
+    task: asyncio.Task | None = None
+    worker: threading.Thread | None = None
+    last_address: str | None = None  # cached from the last good connect
 
     # Product metrics
-    "last_sip_ml": 0.0,
-    "today_ml": 0.0,
-    "all_time_ml": 0.0,
+    last_sip_ml: float = 0.0
+    today_ml: float = 0.0
+    all_time_ml: float = 0.0
 
-    # Tracking for today reset
-    "today_date": datetime.now().date(),
+    # Tracking for today reset (epoch seconds of the next local midnight)
+    next_midnight_ts: float = field(default_factory=next_local_midnight_ts)
 
     # Sip state machine
-    "sip_active": False,
-    "sip_accum_ml": 0.0,
-    "sip_last_active_ts": 0.0,
-}
+    sip_active: bool = False
+    sip_accum_ml: float = 0.0
+    sip_last_active_ts: float = 0.0
+
+    # UI render bookkeeping (only touch widgets when something changed)
+    chart_dirty: bool = True
+    _prev_status: str | None = None
+    _conn_chip_state: bool | None = None
+    _buttons_state: tuple[bool, bool] | None = None
+    # last value shown per label, e.g. {"today": 12.5}
+    _rendered: dict = field(default_factory=dict)
+
+
+state = AppState()
 
 # Rolling buffers for chart
-# We'll store (t_rel_s, flow_lpm)
-t_buf = deque()
-flow_buf = deque()
+# Preallocated ring of (t_rel_s, flow_lpm) rows; ring_head is the next slot
+# to write, ring_count how many rows are filled (capped at CHART_MAXLEN)
+ring = np.empty((CHART_MAXLEN, 2), dtype=np.float64)
+ring_head = 0
+ring_count = 0
+label_buf = deque(maxlen=CHART_MAXLEN)  # preformatted x-axis labels ("12s")
+
+# (ts, mono, payload) per notification, handed from the BLE callback to the
+# RX worker.
+# RESET is queued by the UI so resets run on the worker, in order with frames.
+rx_queue = queue.SimpleQueue()
+RESET = object()
 
 # We choose an anchor time so x-axis is stable and starts at 0
 chart_t0 = None
 
 
-def local_midnight_date():
-    return datetime.now().date()
+def chart_rows() -> np.ndarray:
+    # Ring contents in arrival order (oldest first)
+    if ring_count < CHART_MAXLEN:
+        return ring[:ring_count]
+    return np.concatenate((ring[ring_head:], ring[:ring_head]))
 
 
 def reset_chart():
-    global chart_t0
-    t_buf.clear()
-    flow_buf.clear()
+    global chart_t0, ring_head, ring_count
+    ring_head = 0
+    ring_count = 0
+    label_buf.clear()
     chart_t0 = None
+    state.chart_dirty = True
 
 
 def reset_metrics():
     # Do not touch all-time (device lifetime). Reset "today" and "last sip".
-    state["last_sip_ml"] = 0.0
-    state["today_ml"] = 0.0
-    state["today_date"] = local_midnight_date()
+    state.last_sip_ml = 0.0
+    state.today_ml = 0.0
+    state.next_midnight_ts = next_local_midnight_ts()
     # also reset sip-in-progress
-    state["sip_active"] = False
-    state["sip_accum_ml"] = 0.0
-    state["sip_last_active_ts"] = 0.0
+    state.sip_active = False
+    state.sip_accum_ml = 0.0
+    state.sip_last_active_ts = 0.0
 
 
 # ------------------- METRIC UPDATE LOGIC -------------------
-def update_day_rollover_if_needed():
-    today = local_midnight_date()
-    if today != state["today_date"]:
-        # new day: reset daily total and sip accumulator
-        state["today_date"] = today
-        state["today_ml"] = 0.0
-        state["sip_active"] = False
-        state["sip_accum_ml"] = 0.0
-        state["sip_last_active_ts"] = 0.0
+def roll_over_day():
+    # new day: reset daily total and sip accumulator
+    state.next_midnight_ts = next_local_midnight_ts()
+    state.today_ml = 0.0
+    state.sip_active = False
+    state.sip_accum_ml = 0.0
+    state.sip_last_active_ts = 0.0
+
+
+def sip_seconds_left() -> float | None:
+    # Time until the open sip ends if no active sample arrives, else None
+    s = state
+    if not s.sip_active:
+        return None
+    return max(0.0, s.sip_last_active_ts + SIP_GAP_SECONDS - time.monotonic())
 
 
-def process_sample(sample: FlowSample):
-    global chart_t0
+def finalize_sip():
+    s = state
+    if not s.sip_active:
+        return
+    s.last_sip_ml = s.sip_accum_ml
+    s.sip_active = False
+    s.sip_accum_ml = 0.0
+
 
-    state["last_sample"] = sample
+def process_samples(samples: list[FlowSample]):
+    global chart_t0, ring_head, ring_count
+    s = state  # one global lookup, then slot access
+
+    last = samples[-1]
+    s.last_sample = last
 
     # --- all-time from device total ---
-    state["all_time_ml"] = max(0.0, sample.total_l * 1000.0)
-
-    # --- daily rollover check ---
-    update_day_rollover_if_needed()
-
-    # --- today total accumulates from interval volume ---
-    # (Assumes firmware is sending vol_ml_interval once per ~1s interval)
-    if sample.vol_ml >= 0:
-        state["today_ml"] += sample.vol_ml
-
-    # --- sip detection ---
-    now = sample.ts
-    is_active = sample.vol_ml >= SIP_ACTIVE_THRESHOLD_ML
-
-    if is_active:
-        if not state["sip_active"]:
-            state["sip_active"] = True
-            state["sip_accum_ml"] = 0.0
-        state["sip_accum_ml"] += sample.vol_ml
-        state["sip_last_active_ts"] = now
-    else:
-        # If we were in a sip, check if it's time to finalize it
-        if state["sip_active"] and (now - state["sip_last_active_ts"] >= SIP_GAP_SECONDS):
-            # finalize sip
-            state["last_sip_ml"] = state["sip_accum_ml"]
-            state["sip_active"] = False
-            state["sip_accum_ml"] = 0.0
+    s.all_time_ml = max(0.0, last.total_l * 1000.0)
+
+    # --- daily rollover check (one float compare, no datetime per batch) ---
+    # Calendar question, so wall clock: monotonic stops during suspend/sleep
+    if last.ts >= s.next_midnight_ts:
+        roll_over_day()
+
+    # --- today total + sip detection (locals, state written once) ---
+    # Ending a sip is not decided here: the RX worker finalizes it once
+    # SIP_GAP_SECONDS pass without an active sample (see finalize_sip).
+    today_ml = s.today_ml
+    sip_active = s.sip_active
+    sip_accum_ml = s.sip_accum_ml
+    sip_last_active_ts = s.sip_last_active_ts
+
+    for sample in samples:
+        vol_ml = sample.vol_ml
+
+        # today total accumulates from interval volume
+        # (Assumes firmware is sending vol_ml_interval once per ~0.1s interval)
+        # (ordered compare, so a NaN interval is dropped rather than poisoning it)
+        if vol_ml >= 0:
+            today_ml += vol_ml
+
+        # active: extend the running sip (or start from 0); idle: hold
+        if vol_ml >= SIP_ACTIVE_THRESHOLD_ML:
+            sip_accum_ml = sip_accum_ml + vol_ml if sip_active else vol_ml
+            sip_active = True
+            sip_last_active_ts = sample.mono
+
+    s.today_ml = today_ml
+    s.sip_active = sip_active
+    s.sip_accum_ml = sip_accum_ml
+    s.sip_last_active_ts = sip_last_active_ts
 
     # --- chart update (relative seconds) ---
     if chart_t0 is None:
-        chart_t0 = sample.ts
+        chart_t0 = samples[0].mono
+
+    # Whole batch lands in the ring with at most two contiguous slice writes
+    # (up to the end of the ring, then the wrapped remainder at the front)
+    t_rels = [x.mono - chart_t0 for x in samples]
+    rows = list(zip(t_rels, [x.flow_lpm for x in samples]))[-CHART_MAXLEN:]
+    n = len(rows)
+    k = min(n, CHART_MAXLEN - ring_head)
+    ring[ring_head:ring_head + k] = rows[:k]
+    if n > k:
+        ring[:n - k] = rows[k:]
+    ring_head = (ring_head + n) % CHART_MAXLEN
+    ring_count = min(ring_count + n, CHART_MAXLEN)
+    label_buf.extend(f"{t:.0f}s" for t in t_rels)
+    s.chart_dirty = True
+
+
+# ------------------- RX WORKER -------------------
+def rx_step():
+    # Block for the first frame, but wake up when an open sip's pause
+    # runs out, so it ends on time even if no more frames arrive
+    try:
+        frames = [rx_queue.get(timeout=sip_seconds_left())]
+    except queue.Empty:
+        frames = []
+
+    reset = False
+    if frames and frames[0] is RESET:
+        frames, reset = [], True
+    elif frames:
+        # Give the rest of the batch time to land; stop early at a reset so
+        # frames queued before it are processed first
+        time.sleep(RX_BATCH_S)
+        try:
+            while True:
+                frame = rx_queue.get_nowait()
+                if frame is RESET:
+                    reset = True
+                    break
+                frames.append(frame)
+        except queue.Empty:
+            pass
+
+    samples = [parse_binary_payload(*f) for f in frames]
+    samples = [s for s in samples if s]
+    if samples:
+        process_samples(samples)
 
-    t_rel = sample.ts - chart_t0
-    t_buf.append(t_rel)
-    flow_buf.append(sample.flow_lpm)
+    if reset:
+        reset_metrics()
+        reset_chart()
 
-    # Trim to last CHART_SECONDS_WINDOW seconds
-    while t_buf and (t_rel - t_buf[0] > CHART_SECONDS_WINDOW):
-        t_buf.popleft()
-        flow_buf.popleft()
+    if sip_seconds_left() == 0.0:
+        finalize_sip()
+
+
+def rx_worker():
+    # Runs on its own thread so parsing/aggregation never blocks the UI loop.
+    # Metric/chart state is only written here (UI resets arrive as RESET);
+    # the UI thread just reads it, plus the connection fields it owns.
+    while True:
+        try:
+            rx_step()
+        except Exception as e:
+            state.status = f"RX error: {type(e).__name__}: {e}"
+
+
+def ensure_rx_worker():
+    if state.worker is None:
+        state.worker = threading.Thread(target=rx_worker, daemon=True)
+        state.worker.start()
 
 
 # ------------------- BLE LOGIC -------------------
-async def ble_stream_loop():
-    while state["running"]:
-        state["status"] = "Scanning for BLE device…"
-        state["connected"] = False
-        await asyncio.sleep(0)
+def is_target_device(device, adv) -> bool:
+    # Must advertise NUS *and* carry our name (NUS alone is the stock Nordic
+    # UART service, so unrelated peripherals match it too). The name often
+    # comes in the scan response; the filter is re-run once it arrives.
+    # Robust name matching: exact name or contains (case-insensitive)
+    if NUS_SERVICE_UUID.lower() not in (adv.service_uuids or []):
+        return False
+    name = device.name or adv.local_name
+    return bool(name) and DEVICE_NAME.lower() in name.lower()
 
-        devices = await BleakScanner.discover(timeout=10.0)
-
-        # Robust matching: exact match, then contains
-        target = None
-        for d in devices:
-            if d.name == DEVICE_NAME:
-                target = d
-                break
-        if not target:
-            for d in devices:
-                if d.name and DEVICE_NAME.lower() in d.name.lower():
-                    target = d
-                    break
 
-        if not target:
-            found_names = sorted({d.name for d in devices if d.name})
-            preview = ", ".join(
-                found_names[:8]) if found_names else "(no named devices)"
-            state["status"] = f"Not found: {DEVICE_NAME}. Found: {preview}. Retrying…"
-            await asyncio.sleep(2.0)
-            continue
+async def ble_stream_loop():
+    while state.running:
+        state.connected = False
+        await asyncio.sleep(0)
 
-        state["status"] = f"Connecting to {target.name} ({target.address})…"
+        # Known MAC from an earlier session: connect directly, skip the scan
+        address = state.last_address
+        if address:
+            state.status = f"Reconnecting to {address}…"
+            connect_timeout = 5.0
+        else:
+            state.status = "Scanning for BLE device…"
+            # Stops scanning as soon as a matching advertiser is seen
+            # service_uuids lets backends that support it filter in the OS
+            target = await BleakScanner.find_device_by_filter(
+                is_target_device, timeout=10.0,
+                service_uuids=[NUS_SERVICE_UUID])
+
+            if not target:
+                state.status = f"Not found: {DEVICE_NAME}. Retrying…"
+                await asyncio.sleep(2.0)
+                continue
+
+            address = target.address
+            state.status = f"Connecting to {target.name} ({address})…"
+            connect_timeout = 10.0
 
         def on_notify(_: int, data: bytearray):
-            s = data.decode("utf-8", errors="ignore").strip()
-            sample = parse_csv_payload(s)
-            if not sample:
-                return
-            process_sample(sample)
+            rx_queue.put_nowait((time.time(), time.monotonic(), bytes(data)))
 
+        session_started = False
         try:
-            async with BleakClient(target.address) as client:
-                state["client"] = client
-                state["connected"] = True
-                state["status"] = "Connected. Subscribed to notifications."
+            async with BleakClient(address, timeout=connect_timeout) as client:
+                session_started = True
+                state.last_address = address
+                state.client = client
+                state.connected = True
+                state.status = "Connected. Subscribed to notifications."
                 await client.start_notify(NUS_TX_UUID, on_notify)
 
-                while state["running"] and client.is_connected:
+                while state.running and client.is_connected:
                     await asyncio.sleep(0.5)
 
         except Exception as e:
-            state["status"] = f"BLE error: {type(e).__name__}: {e}"
+            state.status = f"BLE error: {type(e).__name__}: {e}"
+            if not session_started:
+                # Cached address may be stale; scan again on the next attempt
+                state.last_address = None
 
         finally:
-            state["connected"] = False
-            state["client"] = None
+            state.connected = False
+            state.client = None
 
-        if state["running"]:
-            state["status"] = "Disconnected. Reconnecting…"
+        if state.running:
+            state.status = "Disconnected. Reconnecting…"
             await asyncio.sleep(1.5)
 
-    state["status"] = "Stopped."
+    state.status = "Stopped."
 
 
 def start_stream():
-    if state["running"]:
+    if state.running:
         return
-    state["running"] = True
-    state["task"] = asyncio.create_task(ble_stream_loop())
+    state.running = True
+    ensure_rx_worker()
+    state.task = asyncio.create_task(ble_stream_loop())
 
 
 async def disconnect():
-    state["running"] = False
+    state.running = False
 
-    client = state.get("client")
+    client = state.client
     if client:
         try:
             await client.stop_notify(NUS_TX_UUID)
@@ -269,10 +407,10 @@ async def disconnect():
         except Exception:
             pass
 
-    state["connected"] = False
-    state["client"] = None
-    state["task"] = None
-    state["status"] = "Disconnected."
+    state.connected = False
+    state.client = None
+    state.task = None
+    state.status = "Disconnected."
 
 
 # ------------------- UI -------------------
@@ -319,6 +457,7 @@ with ui.column().classes("w-full max-w-5xl mx-auto p-6 gap-4"):
             "series": [{"type": "line", "data": [], "smooth": True, "showSymbol": False}],
             "grid": {"left": 50, "right": 20, "top": 30, "bottom": 40},
             "tooltip": {"trigger": "axis"},
+            "animation": False,  # no client-side tween on every redraw
         }).classes("w-full").style("height: 260px;")
 
     # Controls
@@ -329,41 +468,67 @@ with ui.column().classes("w-full max-w-5xl mx-auto p-6 gap-4"):
             disconnect())).props("outline")
 
         def reset_ui():
-            reset_metrics()
-            reset_chart()
+            # Applied by the RX worker so it can't race a batch in flight
+            ensure_rx_worker()
+            rx_queue.put_nowait(RESET)
 
         ui.button("Reset totals/chart", on_click=reset_ui).props("outline")
 
-    def tick():
-        # status
-        status_chip.text = state["status"] or "—"
+    def show_metric(key: str, label, value: float):
+        rendered = state._rendered
+        if rendered.get(key) != value:
+            label.text = f"{value:.1f}"
+            rendered[key] = value
 
-        if state["connected"]:
-            conn_chip.text = "Connected"
-            conn_chip.classes("bg-green-2", remove="bg-red-2")
-        else:
-            conn_chip.text = "Disconnected"
-            conn_chip.classes("bg-red-2", remove="bg-green-2")
+    def tick_cheap():
+        s = state  # one global lookup per frame, then slot access
+        # status
+        if s.status != s._prev_status:
+            status_chip.text = s.status or "—"
+            s._prev_status = s.status
+
+        # connection chip (only on transition; .classes() ships a delta)
+        if s.connected != s._conn_chip_state:
+            if s.connected:
+                conn_chip.text = "Connected"
+                conn_chip.classes("bg-green-2", remove="bg-red-2")
+            else:
+                conn_chip.text = "Disconnected"
+                conn_chip.classes("bg-red-2", remove="bg-green-2")
+            s._conn_chip_state = s.connected
 
         # buttons
-        start_btn.enabled = not state["running"]
-        disc_btn.enabled = state["running"] or state["connected"]
+        buttons = (not s.running, s.running or s.connected)
+        if buttons != s._buttons_state:
+            start_btn.enabled, disc_btn.enabled = buttons
+            s._buttons_state = buttons
+
+        rendered = s._rendered
 
         # last update
-        samp: FlowSample | None = state["last_sample"]
-        last_update.text = time.strftime(
-            "%H:%M:%S", time.localtime(samp.ts)) if samp else "—"
-
-        # product metrics (format nicely)
-        last_sip_value.text = f"{state['last_sip_ml']:.1f}"
-        today_value.text = f"{state['today_ml']:.1f}"
-        all_time_value.text = f"{state['all_time_ml']:.1f}"
-
-        # chart with relative seconds labels
-        chart.options["xAxis"]["data"] = [f"{t:.0f}s" for t in t_buf]
-        chart.options["series"][0]["data"] = list(flow_buf)
+        samp: FlowSample | None = s.last_sample
+        if samp is not rendered.get("sample", ()):
+            last_update.text = time.strftime(
+                "%H:%M:%S", time.localtime(samp.ts)) if samp else "—"
+            rendered["sample"] = samp
+
+        # product metrics (format nicely, only when the value moved)
+        show_metric("last_sip", last_sip_value, s.last_sip_ml)
+        show_metric("today", today_value, s.today_ml)
+        show_metric("all_time", all_time_value, s.all_time_ml)
+
+    def tick_chart():
+        s = state
+        # chart with relative seconds labels (only when new points arrived)
+        if not s.chart_dirty:
+            return
+        s.chart_dirty = False
+        chart.options["xAxis"]["data"] = list(label_buf)
+        # float32 from the wire; round so the chart/tooltip show clean values
+        chart.options["series"][0]["data"] = chart_rows()[:, 1].round(3).tolist()
         chart.update()
 
-    ui.timer(UI_REFRESH_S, tick)
+    ui.timer(UI_REFRESH_S, tick_cheap)
+    ui.timer(CHART_REFRESH_S, tick_chart)
 
 ui.run(reload=False, host="127.0.0.1", port=8080)
@@ -85,8 +85,7 @@ void setupBLE()
   // CCCD descriptor so apps can enable notifications
   pCharacteristic->addDescriptor(new BLE2902());
 
-  // Optional initial value (header)
-  pCharacteristic->setValue("pulses,frequency_hz,flow_l_min,vol_ml_interval,total_l");
+  // Payload is a packed binary frame (see loop()), so no text header value
 
   pService->start();
 
@@ -168,20 +167,20 @@ void loop()
     Serial.println(" L");
     Serial.println();
 
-    // Send BLE notification (CSV payload)
+    // Send BLE notification (binary payload, 20 bytes, little-endian)
     if (deviceConnected && pCharacteristic)
     {
-      char payload[128];
-      // pulses,frequency_hz,flow_l_min,vol_ml_interval,total_l
-      snprintf(payload, sizeof(payload),
-               "%lu,%.2f,%.3f,%.2f,%.4f",
-               pulses,
-               frequency,
-               flowRate,
-               volumeThisInterval_mL,
-               totalVolume);
-
-      pCharacteristic->setValue((uint8_t *)payload, strlen(payload));
+      // uint32 pulses, float32 frequency_hz, flow_l_min, vol_ml_interval, total_l
+      // (matches struct "<Iffff" on the receiver; ESP32 is little-endian)
+      uint8_t payload[20];
+      uint32_t pulses32 = (uint32_t)pulses;
+      memcpy(payload + 0, &pulses32, 4);
+      memcpy(payload + 4, &frequency, 4);
+      memcpy(payload + 8, &flowRate, 4);
+      memcpy(payload + 12, &volumeThisInterval_mL, 4);
+      memcpy(payload + 16, &totalVolume, 4);
+
+      pCharacteristic->setValue(payload, sizeof(payload));
       pCharacteristic->notify();
     }
 
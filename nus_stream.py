@@ -1,4 +1,5 @@
 import asyncio
+import struct
 from bleak import BleakScanner, BleakClient
 
 # Nordic UART Service (NUS) UUIDs
@@ -8,11 +9,15 @@ NUS_TX_UUID      = "6E400003-B5A3-F393-E0A9-E50E24DCCA9E"  # Notify: ESP32 -> PC
 
 DEVICE_NAME = "XIAO_Flow"
 
+# Binary frame: uint32 pulses, float32 frequency_hz, flow_l_min, vol_ml_interval, total_l
+FRAME = struct.Struct("<Iffff")
+
 def handle_notify(_: int, data: bytearray):
-    # If you send ASCII text (recommended), decode it:
-    try:
-        print(data.decode("utf-8", errors="ignore").strip())
-    except Exception:
+    # Firmware sends packed binary frames; fall back to raw bytes otherwise
+    if len(data) == FRAME.size:
+        pulses, freq_hz, flow_lpm, vol_ml, total_l = FRAME.unpack(data)
+        print(f"{pulses},{freq_hz:.2f},{flow_lpm:.3f},{vol_ml:.2f},{total_l:.4f}")
+    else:
         print(list(data))
 
 async def main():